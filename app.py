@@ -1,7 +1,6 @@
 from flask import Flask, request, Response
 import os
 import requests
-from bs4 import BeautifulSoup
 import time
 from dotenv import load_dotenv
 import json
@@ -10,8 +9,25 @@ from datetime import datetime
 import zipfile
 import re
 import logging
-from PIL import Image
+from PIL import Image, ImageDraw
 import io
+import hashlib
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import uuid
+import threading
+from collections import deque
+from itertools import islice
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urljoin, urlparse
+from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+from urllib3.util.retry import Retry
 
 # Set up logging
 logging.basicConfig(
@@ -28,8 +44,345 @@ app = Flask(__name__)
 # Initialize Redis
 redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
 
+# WhatsApp media messages allowed per user in a rolling 24h window
+MEDIA_DAILY_LIMIT = 12
+MEDIA_WINDOW_SECONDS = 24 * 60 * 60
+
+# Atomically check the quota and reserve a slot: returns the new count or -1
+RESERVE_MEDIA_SLOT_LUA = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+if count >= tonumber(ARGV[1]) then
+    return -1
+end
+count = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return count
+"""
+
+# Give back a reserved slot when the send did not go through
+RELEASE_MEDIA_SLOT_LUA = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+if count > 0 then
+    return redis.call('DECR', KEYS[1])
+end
+return 0
+"""
+
+reserve_media_slot_script = redis_client.register_script(RESERVE_MEDIA_SLOT_LUA)
+release_media_slot_script = redis_client.register_script(RELEASE_MEDIA_SLOT_LUA)
+
+# Single-flight chapter builds: the lease is renewed while the leader works
+SINGLE_FLIGHT_LEASE = int(os.getenv('SINGLE_FLIGHT_LEASE', 60))
+CHAPTER_WAITERS_TTL = 6 * 60 * 60
+
+# Renew / release a lock only while we still own it
+EXTEND_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+extend_lock_script = redis_client.register_script(EXTEND_LOCK_LUA)
+release_lock_script = redis_client.register_script(RELEASE_LOCK_LUA)
+
+# Optional prefetcher that pre-builds new chapters of recently requested series
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+PREFETCH_INTERVAL = int(os.getenv('PREFETCH_INTERVAL', 600))
+PREFETCH_SERIES_WINDOW = int(os.getenv('PREFETCH_SERIES_WINDOW', 3 * 24 * 60 * 60))
+PREFETCH_MAX_PER_SERIES = int(os.getenv('PREFETCH_MAX_PER_SERIES', 2))
+
+# Batch (chapter range / whole series) requests
+BATCH_MAX_CHAPTERS = int(os.getenv('BATCH_MAX_CHAPTERS', 50))
+BATCH_PARALLEL_CHAPTERS = int(os.getenv('BATCH_PARALLEL_CHAPTERS', 3))
+
+# Chapter jobs are pushed here by the webhook and drained by worker.py.
+# Each priority keeps one FIFO per sender plus a round-robin list of senders
+# with pending work; a sender never has more than USER_MAX_INFLIGHT jobs running.
+JOB_QUEUE_KEY = "manga_jobs"
+JOB_SIGNAL_KEY = f"{JOB_QUEUE_KEY}:signal"
+JOB_DEPTH_KEY = f"{JOB_QUEUE_KEY}:depth"
+PRIORITY_CHAPTER = 0
+PRIORITY_BATCH = 1
+PRIORITY_PREFETCH = 2
+JOB_PRIORITIES = (PRIORITY_CHAPTER, PRIORITY_BATCH, PRIORITY_PREFETCH)
+# Prefetch builds are queued under this pseudo-sender, so they share one in-flight slot
+PREFETCH_SENDER = "prefetch"
+USER_MAX_INFLIGHT = int(os.getenv('USER_MAX_INFLIGHT', 1))
+# worker_id -> sender of the job it is running, so a dead worker's slot can be given back
+JOB_SLOTS_KEY = f"{JOB_QUEUE_KEY}:slots"
+
+# Shared by the scheduler scripts: free the in-flight slot `worker` holds, if any
+RELEASE_SLOT_LUA = """
+local function release_slot(slots, prefix, worker)
+    local sender = redis.call('HGET', slots, worker)
+    if not sender then
+        return 0
+    end
+    redis.call('HDEL', slots, worker)
+    local inflight = prefix .. ':inflight:' .. sender
+    if tonumber(redis.call('GET', inflight) or '0') > 1 then
+        redis.call('DECR', inflight)
+    else
+        redis.call('DEL', inflight)
+    end
+    return 1
+end
+"""
+
+# Append a job to the sender's queue and put the sender in the rotation if new
+ENQUEUE_JOB_LUA = """
+if redis.call('RPUSH', KEYS[1], ARGV[2]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+redis.call('INCR', KEYS[3])
+redis.call('INCR', KEYS[5])
+redis.call('RPUSH', KEYS[4], '1')
+redis.call('LTRIM', KEYS[4], 0, 99)
+return 1
+"""
+
+# Pop the next job: highest priority first, round-robin across senders,
+# skipping senders already at their in-flight cap. A slot this worker still
+# holds means its last finish_job never reached Redis, so it is freed first.
+DEQUEUE_JOB_LUA = RELEASE_SLOT_LUA + """
+local prefix = ARGV[1]
+local max_inflight = tonumber(ARGV[2])
+release_slot(KEYS[2], prefix, ARGV[4])
+for priority = 0, tonumber(ARGV[3]) - 1 do
+    local ready = prefix .. ':' .. priority .. ':ready'
+    for i = 1, redis.call('LLEN', ready) do
+        local sender = redis.call('LPOP', ready)
+        local queue = prefix .. ':' .. priority .. ':user:' .. sender
+        local inflight = prefix .. ':inflight:' .. sender
+        if tonumber(redis.call('GET', inflight) or '0') < max_inflight then
+            local job = redis.call('LPOP', queue)
+            if redis.call('LLEN', queue) > 0 then
+                redis.call('RPUSH', ready, sender)
+            end
+            if job then
+                redis.call('INCR', inflight)
+                redis.call('HSET', KEYS[2], ARGV[4], sender)
+                for _, depth in ipairs({KEYS[1], prefix .. ':' .. priority .. ':depth'}) do
+                    if tonumber(redis.call('DECR', depth)) < 0 then
+                        redis.call('SET', depth, 0)
+                    end
+                end
+                return job
+            end
+        else
+            redis.call('RPUSH', ready, sender)
+        end
+    end
+end
+return false
+"""
+
+# Mark a sender's job as done and wake a worker for their next one
+# (unless the slot was already reclaimed from this worker as dead)
+FINISH_JOB_LUA = RELEASE_SLOT_LUA + """
+redis.call('RPUSH', KEYS[1], '1')
+redis.call('LTRIM', KEYS[1], 0, 99)
+return release_slot(KEYS[2], ARGV[1], ARGV[2])
+"""
+
+# Give back the slots held by workers whose heartbeat went stale (or by ARGV[3])
+RELEASE_JOB_SLOTS_LUA = RELEASE_SLOT_LUA + """
+local released = 0
+local slots = redis.call('HKEYS', KEYS[1])
+for _, worker in ipairs(slots) do
+    local seen = tonumber(redis.call('ZSCORE', KEYS[2], worker) or '0')
+    if worker == ARGV[3] or seen < tonumber(ARGV[2]) then
+        released = released + release_slot(KEYS[1], ARGV[1], worker)
+    end
+end
+if ARGV[3] ~= '' then
+    redis.call('ZREM', KEYS[2], ARGV[3])
+    redis.call('ZREM', KEYS[3], ARGV[3])
+end
+if released > 0 then
+    redis.call('RPUSH', KEYS[4], '1')
+    redis.call('LTRIM', KEYS[4], 0, 99)
+end
+return released
+"""
+
+# Fold one job duration into the exponential moving average
+UPDATE_JOB_DURATION_LUA = """
+local sample = tonumber(ARGV[1])
+local average = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+average = average + tonumber(ARGV[2]) * (sample - average)
+redis.call('SET', KEYS[1], tostring(average))
+return tostring(average)
+"""
+
+enqueue_job_script = redis_client.register_script(ENQUEUE_JOB_LUA)
+dequeue_job_script = redis_client.register_script(DEQUEUE_JOB_LUA)
+finish_job_script = redis_client.register_script(FINISH_JOB_LUA)
+release_job_slots_script = redis_client.register_script(RELEASE_JOB_SLOTS_LUA)
+update_job_duration_script = redis_client.register_script(UPDATE_JOB_DURATION_LUA)
+
+# Worker heartbeats (live and busy sets) and the average build time of each
+# job type feed admission control
+JOB_WORKERS_KEY = f"{JOB_QUEUE_KEY}:workers"
+JOB_BUSY_KEY = f"{JOB_QUEUE_KEY}:busy"
+JOB_DURATION_KEY = f"{JOB_QUEUE_KEY}:avg_duration"
+WORKER_HEARTBEAT_INTERVAL = int(os.getenv('WORKER_HEARTBEAT_INTERVAL', 10))
+WORKER_HEARTBEAT_TTL = int(os.getenv('WORKER_HEARTBEAT_TTL', 30))
+JOB_DURATION_ALPHA = float(os.getenv('JOB_DURATION_ALPHA', 0.2))
+DEFAULT_JOB_SECONDS = {
+    "chapter": float(os.getenv('DEFAULT_CHAPTER_JOB_SECONDS', 60)),
+    "batch": float(os.getenv('DEFAULT_BATCH_JOB_SECONDS', 15 * 60))
+}
+
+# Above these the webhook turns requests away with an estimated wait instead of queueing them
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', 200))
+ADMISSION_MAX_UTILIZATION = float(os.getenv('ADMISSION_MAX_UTILIZATION', 1.0))
+ADMISSION_MAX_WAIT = int(os.getenv('ADMISSION_MAX_WAIT', 30 * 60))
+# Threads per web process that send "busy"/"invalid URL" replies off the request path
+NOTICE_WORKERS = int(os.getenv('NOTICE_WORKERS', 4))
+
+# Shared Graph API connection pool
+GRAPH_POOL_SIZE = int(os.getenv('GRAPH_POOL_SIZE', 10))
+GRAPH_MAX_RETRIES = int(os.getenv('GRAPH_MAX_RETRIES', 3))
+GRAPH_BACKOFF_FACTOR = float(os.getenv('GRAPH_BACKOFF_FACTOR', 0.5))
+GRAPH_TIMEOUT = int(os.getenv('GRAPH_TIMEOUT', 120))
+
+# Each job spools its pages and PDF parts into its own directory under here
+TEMP_DIR = os.getenv('TEMP_DIR', 'temp_manga')
+
+# Background janitor: age-based temp cleanup plus disk-usage watermarks
+JANITOR_INTERVAL = int(os.getenv('JANITOR_INTERVAL', 300))
+TEMP_MAX_AGE_HOURS = float(os.getenv('TEMP_MAX_AGE_HOURS', 1))
+DISK_HIGH_WATERMARK = float(os.getenv('DISK_HIGH_WATERMARK', 0.90))
+DISK_LOW_WATERMARK = float(os.getenv('DISK_LOW_WATERMARK', 0.80))
+JANITOR_ACTIVE_GRACE = int(os.getenv('JANITOR_ACTIVE_GRACE', 120))
+# Most cached chapter bytes one janitor pass may evict for disk pressure
+JANITOR_MAX_EVICT_BYTES = int(os.getenv('JANITOR_MAX_EVICT_BYTES', 512 * 1024 * 1024))
+
+# Finished chapter PDFs, indexed in Redis by normalized chapter URL
+CHAPTER_CACHE_DIR = os.getenv('CHAPTER_CACHE_DIR', 'manga_cache')
+CHAPTER_CACHE_MAX_BYTES = int(os.getenv('CHAPTER_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Drop a cache entry and release its byte count and file refcounts in one step,
+# so two evictors racing on the same entry can't both account for it. Returns
+# the freed size followed by the files nothing references any more.
+REMOVE_CACHED_CHAPTER_LUA = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+local entry = redis.call('HMGET', KEYS[1], 'files', 'digests', 'size')
+if redis.call('DEL', KEYS[1]) == 0 then
+    return {0}
+end
+local size = tonumber(entry[3] or '0')
+redis.call('DECRBY', KEYS[3], size)
+local result = {size}
+local files = cjson.decode(entry[1])
+for i, digest in ipairs(cjson.decode(entry[2])) do
+    if redis.call('HINCRBY', KEYS[4], digest, -1) <= 0 then
+        redis.call('HDEL', KEYS[4], digest)
+        table.insert(result, files[i])
+    end
+end
+return result
+"""
+
+remove_cached_chapter_script = redis_client.register_script(REMOVE_CACHED_CHAPTER_LUA)
+
+# Uploaded media stays on WhatsApp for 30 days; keep IDs a day less to be safe
+MEDIA_ID_TTL = int(os.getenv('MEDIA_ID_TTL', 29 * 24 * 60 * 60))
+
+# WhatsApp rejects documents above 100MB
+WHATSAPP_MAX_DOCUMENT_BYTES = 100 * 1024 * 1024
+
+# Page normalization applied before pages go into the PDF
+PAGE_MAX_WIDTH = int(os.getenv('PAGE_MAX_WIDTH', 1200))  # 0 keeps the original width
+PAGE_JPEG_QUALITY = int(os.getenv('PAGE_JPEG_QUALITY', 80))
+PAGE_MIN_JPEG_QUALITY = int(os.getenv('PAGE_MIN_JPEG_QUALITY', 40))
+PAGE_GRAYSCALE = os.getenv('PAGE_GRAYSCALE', 'false').lower() in ('1', 'true', 'yes')
+# Target size for a whole chapter PDF, spread evenly over its remaining pages
+PDF_SIZE_BUDGET = int(os.getenv('PDF_SIZE_BUDGET', 90 * 1024 * 1024))
+
+# Chapter worker processes started by worker.py, one job at a time each
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', os.cpu_count() or 1))
+# How long a stopping supervisor lets workers finish their current job before killing them
+WORKER_SHUTDOWN_TIMEOUT = int(os.getenv('WORKER_SHUTDOWN_TIMEOUT', 300))
+
+# Page decode/encode runs on a per-worker process pool (0 runs inline). A box
+# runs WORKER_PROCESSES * (1 + TRANSCODE_PROCESSES) processes, so by default
+# the cores are shared out between workers, and a worker left with a single
+# core transcodes inline rather than spawning a pool
+_cores_per_worker = (os.cpu_count() or 1) // max(WORKER_PROCESSES, 1)
+TRANSCODE_PROCESSES = int(os.getenv('TRANSCODE_PROCESSES', _cores_per_worker if _cores_per_worker > 1 else 0))
+TRANSCODE_WINDOW = int(os.getenv('TRANSCODE_WINDOW', max(TRANSCODE_PROCESSES, 1) * 2))
+
+# Chapters are split into several PDFs once a part reaches this size
+PDF_PART_MAX_BYTES = int(os.getenv('PDF_PART_MAX_BYTES', 95 * 1024 * 1024))
+
+# Parsed chapter page lists: trusted without a request while fresh, then revalidated
+PAGE_LIST_FRESH_SECONDS = int(os.getenv('PAGE_LIST_FRESH_SECONDS', 300))
+PAGE_LIST_TTL = int(os.getenv('PAGE_LIST_TTL', 7 * 24 * 60 * 60))
+
+# Pick the largest srcset candidate at most this wide (0 takes the largest available)
+SRCSET_MAX_WIDTH = int(os.getenv('SRCSET_MAX_WIDTH', PAGE_MAX_WIDTH))
+
+# Image download tuning (per worker process)
+DOWNLOAD_MAX_WORKERS = int(os.getenv('DOWNLOAD_MAX_WORKERS', 8))
+DOWNLOAD_CONCURRENCY_PER_HOST = int(os.getenv('DOWNLOAD_CONCURRENCY_PER_HOST', 4))
+DOWNLOAD_RATE_PER_HOST = float(os.getenv('DOWNLOAD_RATE_PER_HOST', 4))  # requests/second
+DOWNLOAD_BURST = int(os.getenv('DOWNLOAD_BURST', 4))
+DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', 30))
+# Per-page retries; a page that still fails either fails the chapter or becomes a placeholder
+PAGE_MAX_RETRIES = int(os.getenv('PAGE_MAX_RETRIES', 4))
+PAGE_RETRY_BACKOFF = float(os.getenv('PAGE_RETRY_BACKOFF', 1.0))
+PAGE_FAILURE_POLICY = os.getenv('PAGE_FAILURE_POLICY', 'placeholder')  # 'placeholder' or 'fail'
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# Largest single page we accept; anything bigger is aborted mid-transfer
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', 20 * 1024 * 1024))
+# Max pages downloaded ahead of the PDF writer; bounds memory per chapter
+DOWNLOAD_WINDOW = int(os.getenv('DOWNLOAD_WINDOW', DOWNLOAD_MAX_WORKERS * 2))
+
+_graph_session = None
+_graph_session_pid = None
+_graph_session_lock = threading.Lock()
+
+def get_graph_session():
+    """Process-wide keep-alive session shared by every WhatsAppFileSender.
+
+    Rebuilt after a fork so worker processes never share sockets with
+    their parent.
+    """
+    global _graph_session, _graph_session_pid
+    with _graph_session_lock:
+        if _graph_session is None or _graph_session_pid != os.getpid():
+            retry = Retry(
+                total=GRAPH_MAX_RETRIES,
+                backoff_factor=GRAPH_BACKOFF_FACTOR,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'POST']),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=GRAPH_POOL_SIZE,
+                max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            _graph_session = session
+            _graph_session_pid = os.getpid()
+        return _graph_session
+
 class WhatsAppFileSender:
     def __init__(self):
+        self.session = get_graph_session()
         self.whatsapp_token = os.getenv('WHATSAPP_TOKEN')
         self.phone_number_id = os.getenv('PHONE_NUMBER_ID')
         self.api_url = f"https://graph.facebook.com/v17.0/{self.phone_number_id}/messages"
@@ -37,18 +390,37 @@ class WhatsAppFileSender:
             "Authorization": f"Bearer {self.whatsapp_token}",
             "Content-Type": "application/json"
         }
+        # Last known quota count per user, so one job doesn't re-read Redis
+        self.media_counts = {}
 
     def get_user_message_count(self, user_number):
         count = redis_client.get(f"whatsapp_count:{user_number}")
-        return int(count) if count else 0
+        self.media_counts[user_number] = int(count) if count else 0
+        return self.media_counts[user_number]
+
+    def reserve_media_slot(self, user_number):
+        """Check-and-increment the quota in one round-trip; False when the limit is reached"""
+        count = reserve_media_slot_script(
+            keys=[f"whatsapp_count:{user_number}"],
+            args=[MEDIA_DAILY_LIMIT, MEDIA_WINDOW_SECONDS]
+        )
+        if count < 0:
+            self.media_counts[user_number] = MEDIA_DAILY_LIMIT
+            return False
+        self.media_counts[user_number] = count
+        return True
 
-    def increment_user_message_count(self, user_number):
-        key = f"whatsapp_count:{user_number}"
-        redis_client.incr(key)
-        redis_client.expire(key, 24 * 60 * 60)
+    def release_media_slot(self, user_number):
+        self.media_counts[user_number] = release_media_slot_script(keys=[f"whatsapp_count:{user_number}"])
 
     def can_send_media(self, user_number):
-        return self.get_user_message_count(user_number) < 12
+        return self.get_user_message_count(user_number) < MEDIA_DAILY_LIMIT
+
+    def remaining_media(self, user_number):
+        """Remaining media messages, reusing the count from this sender's last quota call"""
+        if user_number not in self.media_counts:
+            self.get_user_message_count(user_number)
+        return max(MEDIA_DAILY_LIMIT - self.media_counts[user_number], 0)
 
     def send_text(self, recipient, message):
         try:
@@ -60,10 +432,11 @@ class WhatsAppFileSender:
                 "text": {"body": message}
             }
             
-            response = requests.post(
+            response = self.session.post(
                 self.api_url,
                 headers=self.headers,
-                json=payload
+                json=payload,
+                timeout=GRAPH_TIMEOUT
             )
             logger.debug(f"Text message response: {response.text}")
             return response.status_code == 200
@@ -71,12 +444,78 @@ class WhatsAppFileSender:
             logger.error(f"Error sending text message: {str(e)}")
             return False
 
-    def send_document(self, recipient, file_path, caption=""):
+    def upload_media(self, file_path):
+        """Upload a PDF to the /media endpoint and return its media ID"""
+        logger.debug(f"Uploading file: {file_path} ({os.path.getsize(file_path)} bytes)")
+        
+        # Open file in binary mode
+        with open(file_path, 'rb') as file:
+            files = {
+                'file': (os.path.basename(file_path), file, 'application/pdf')
+            }
+            data = {
+                'messaging_product': 'whatsapp'
+            }
+            
+            upload_response = self.session.post(
+                f"https://graph.facebook.com/v17.0/{self.phone_number_id}/media",
+                headers={"Authorization": f"Bearer {self.whatsapp_token}"},
+                data=data,
+                files=files,
+                timeout=GRAPH_TIMEOUT
+            )
+
+        logger.debug(f"Upload response: {upload_response.text}")
+        
+        if upload_response.status_code != 200:
+            raise Exception(f"Failed to upload document: {upload_response.text}")
+
+        media_id = upload_response.json().get("id")
+        if not media_id:
+            raise Exception("No media ID received in upload response")
+        return media_id
+
+    def get_media_id(self, file_path, digest):
+        """Reuse the media ID of an identical PDF uploaded earlier, uploading only on a miss"""
+        media_key = f"whatsapp_media:{self.phone_number_id}:{digest}"
+        media_id = redis_client.get(media_key)
+        if media_id:
+            logger.debug(f"Reusing media ID {media_id} for {file_path}")
+            return media_id, True
+
+        media_id = self.upload_media(file_path)
+        redis_client.setex(media_key, MEDIA_ID_TTL, media_id)
+        return media_id, False
+
+    def send_document_message(self, recipient, media_id, caption, filename):
+        payload = {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": recipient,
+            "type": "document",
+            "document": {
+                "id": media_id,
+                "caption": caption,
+                "filename": filename
+            }
+        }
+
+        response = self.session.post(
+            self.api_url,
+            headers=self.headers,
+            json=payload,
+            timeout=GRAPH_TIMEOUT
+        )
+        
+        logger.debug(f"Send document response: {response.text}")
+        return response
+
+    def send_document(self, recipient, file_path, caption="", filename=None):
         ALLOWED_EXTENSIONS = {'.pdf'}
         if not any(file_path.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS):
             raise Exception("Invalid file type")
-        if not self.can_send_media(recipient):
-            return False, "Daily media message limit reached (12/24hrs)"
+        if not self.reserve_media_slot(recipient):
+            return False, f"Daily media message limit reached ({MEDIA_DAILY_LIMIT}/24hrs)"
 
         try:
             # Check if file exists and size
@@ -84,183 +523,1790 @@ class WhatsAppFileSender:
                 raise Exception(f"File not found: {file_path}")
             
             file_size = os.path.getsize(file_path)
-            if file_size > 100 * 1024 * 1024:  # 100MB limit
+            if file_size > WHATSAPP_MAX_DOCUMENT_BYTES:
                 raise Exception("File size exceeds WhatsApp's 100MB limit")
 
-            logger.debug(f"Uploading file: {file_path} ({file_size} bytes)")
-            
-            # Open file in binary mode
-            with open(file_path, 'rb') as file:
-                # Send as application/octet-stream which is generally accepted
-                files = {
-                    'file': (os.path.basename(file_path), file, 'application/pdf')
-                }
-                data = {
-                    'messaging_product': 'whatsapp'
-                }
-                
-                upload_response = requests.post(
-                    f"https://graph.facebook.com/v17.0/{self.phone_number_id}/media",
-                    headers={"Authorization": f"Bearer {self.whatsapp_token}"},
-                    data=data,
-                    files=files
-                )
-
-            logger.debug(f"Upload response: {upload_response.text}")
-            
-            if upload_response.status_code != 200:
-                raise Exception(f"Failed to upload document: {upload_response.text}")
-
-            media_id = upload_response.json().get("id")
-            if not media_id:
-                raise Exception("No media ID received in upload response")
+            filename = filename or os.path.basename(file_path)
+            digest = file_sha256(file_path)
+            media_id, reused = self.get_media_id(file_path, digest)
+            response = self.send_document_message(recipient, media_id, caption, filename)
 
-            # Send document
-            payload = {
-                "messaging_product": "whatsapp",
-                "recipient_type": "individual",
-                "to": recipient,
-                "type": "document",
-                "document": {
-                    "id": media_id,
-                    "caption": caption
-                }
-            }
-
-            response = requests.post(
-                self.api_url,
-                headers=self.headers,
-                json=payload
-            )
-            
-            logger.debug(f"Send document response: {response.text}")
+            if response.status_code != 200 and reused:
+                # The stored media ID may have expired on Meta's side; upload once more
+                logger.warning(f"Send with cached media ID {media_id} failed, re-uploading")
+                redis_client.delete(f"whatsapp_media:{self.phone_number_id}:{digest}")
+                media_id, _ = self.get_media_id(file_path, digest)
+                response = self.send_document_message(recipient, media_id, caption, filename)
 
             if response.status_code == 200:
-                self.increment_user_message_count(recipient)
                 return True, "Success"
+            self.release_media_slot(recipient)
             return False, f"Failed to send: {response.text}"
 
         except Exception as e:
             logger.error(f"Error sending document: {str(e)}")
+            self.release_media_slot(recipient)
             return False, str(e)
 
-def is_processed_message(message_id):
-    """Check if we've already processed this message"""
-    return redis_client.get(f"processed_message:{message_id}") is not None
+def claim_messages(message_ids):
+    """Atomically claim every message ID of a webhook batch for 1 hour, in one round-trip.
 
-def mark_message_processed(message_id):
-    """Mark message as processed with 1-hour expiry"""
-    redis_client.setex(f"processed_message:{message_id}", 3600, "1")
+    Each ID is True only for its first claimer, so parallel webhook retries
+    from Meta can never both start a job for the same message.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for message_id in message_ids:
+        pipe.set(f"processed_message:{message_id}", "1", nx=True, ex=3600)
+    return [bool(result) for result in pipe.execute()]
 
-def cleanup_temp_files(directory="temp_manga", max_age_hours=1):
-    current_time = time.time()
+def temp_entry_stats(path):
+    """(last modified, total bytes) of a temp file or a job directory and its contents"""
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+    newest = os.path.getmtime(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                stat = os.stat(os.path.join(root, filename))
+            except FileNotFoundError:
+                continue
+            newest = max(newest, stat.st_mtime)
+            size += stat.st_size
+    return newest, size
+
+def remove_temp_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def list_temp_entries(directory):
+    """Top-level temp files and job directories as (path, last modified, bytes), oldest first"""
+    entries = []
     for filename in os.listdir(directory):
         filepath = os.path.join(directory, filename)
-        file_age = current_time - os.path.getmtime(filepath)
-        if file_age > max_age_hours * 3600:
-            os.remove(filepath)
+        try:
+            mtime, size = temp_entry_stats(filepath)
+        except FileNotFoundError:
+            continue
+        entries.append((filepath, mtime, size))
+    entries.sort(key=lambda entry: entry[1])
+    return entries
 
-def process_manga_chapter(url, sender_number):
-    logger.info(f"Processing manga chapter: {url} for {sender_number}")
+def cleanup_temp_files(directory=TEMP_DIR, max_age_hours=TEMP_MAX_AGE_HOURS):
+    """Remove temp files and job directories untouched for max_age_hours.
+
+    Returns (entries removed, bytes reclaimed).
+    """
+    if not os.path.isdir(directory):
+        return 0, 0
+    current_time = time.time()
+    removed = reclaimed = 0
+    for filepath, mtime, size in list_temp_entries(directory):
+        if current_time - mtime > max_age_hours * 3600:
+            remove_temp_entry(filepath)
+            removed += 1
+            reclaimed += size
+    return removed, reclaimed
+
+def disk_usage_ratio(directory):
+    usage = shutil.disk_usage(directory)
+    return usage.used / usage.total
+
+def enforce_disk_watermarks(directory=TEMP_DIR):
+    """Free space once a disk is above DISK_HIGH_WATERMARK, down to DISK_LOW_WATERMARK.
+
+    Temp entries go first, oldest first regardless of age (anything touched in
+    the last JANITOR_ACTIVE_GRACE seconds is assumed to be a running job),
+    then least recently used chapter cache entries, judged by the usage of
+    the cache's own filesystem.
+    Returns (entries removed, bytes reclaimed).
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.makedirs(CHAPTER_CACHE_DIR, exist_ok=True)
+    removed = reclaimed = 0
+    temp_pressure = disk_usage_ratio(directory) > DISK_HIGH_WATERMARK
+    if temp_pressure:
+        logger.warning(f"Disk usage above {DISK_HIGH_WATERMARK:.0%}, evicting temp files")
+        current_time = time.time()
+        for filepath, mtime, size in list_temp_entries(directory):
+            if disk_usage_ratio(directory) <= DISK_LOW_WATERMARK:
+                break
+            if current_time - mtime < JANITOR_ACTIVE_GRACE:
+                continue
+            remove_temp_entry(filepath)
+            removed += 1
+            reclaimed += size
+
+    same_disk = os.stat(directory).st_dev == os.stat(CHAPTER_CACHE_DIR).st_dev
+    if disk_usage_ratio(CHAPTER_CACHE_DIR) > DISK_HIGH_WATERMARK or (temp_pressure and same_disk):
+        evicted, evicted_bytes = evict_cache_for_disk_space()
+        removed += evicted
+        reclaimed += evicted_bytes
+    return removed, reclaimed
+
+def evict_cache_for_disk_space(max_bytes=JANITOR_MAX_EVICT_BYTES):
+    """Evict LRU chapters until the cache's disk is below DISK_LOW_WATERMARK.
+
+    At most `max_bytes` are evicted per pass, and eviction stops early once
+    it no longer lowers disk usage (the space is taken by something else),
+    so a disk filled by logs or other data can't wipe the whole cache.
+    """
+    removed = freed = 0
+    stalled = 0
+    used = shutil.disk_usage(CHAPTER_CACHE_DIR).used
+    while freed < max_bytes and disk_usage_ratio(CHAPTER_CACHE_DIR) > DISK_LOW_WATERMARK:
+        oldest = redis_client.zrange("chapter_cache_lru", 0, 0)
+        if not oldest:
+            break
+        freed += remove_cached_chapter(oldest[0])
+        removed += 1
+        logger.info(f"Evicted {oldest[0]} from chapter cache to free disk space")
+        now_used = shutil.disk_usage(CHAPTER_CACHE_DIR).used
+        # A chapter sharing its files with another URL frees nothing; allow a few of those
+        stalled = stalled + 1 if now_used >= used else 0
+        used = now_used
+        if stalled >= 3:
+            logger.warning("Evicting cached chapters is not freeing disk space, stopping")
+            break
+    return removed, freed
+
+def run_janitor():
+    """One janitor pass: expire old temp entries, then enforce the disk watermarks"""
+    expired, expired_bytes = cleanup_temp_files()
+    evicted, evicted_bytes = enforce_disk_watermarks()
+    removed = expired + evicted
+    reclaimed = expired_bytes + evicted_bytes
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hincrby("janitor_stats", "runs", 1)
+    pipe.hincrby("janitor_stats", "entries_removed", removed)
+    pipe.hincrby("janitor_stats", "bytes_reclaimed", reclaimed)
+    pipe.hset("janitor_stats", "last_run", time.time())
+    pipe.execute()
+    if removed:
+        logger.info(f"Janitor removed {removed} entries, reclaimed {reclaimed} bytes")
+    return removed, reclaimed
+
+def start_janitor(interval=JANITOR_INTERVAL):
+    """Run the janitor every `interval` seconds on a daemon thread"""
+    def loop():
+        while True:
+            try:
+                run_janitor()
+            except Exception as e:
+                logger.error(f"Janitor pass failed: {str(e)}", exc_info=True)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="janitor", daemon=True)
+    thread.start()
+    return thread
+
+class TokenBucket:
+    """Thread-safe token bucket used to pace requests to a single host"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Shared by every download in this process so concurrent chapters stay polite too
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+def get_host_limiter(host):
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = (
+                threading.BoundedSemaphore(DOWNLOAD_CONCURRENCY_PER_HOST),
+                TokenBucket(DOWNLOAD_RATE_PER_HOST, DOWNLOAD_BURST)
+            )
+        return _host_limiters[host]
+
+def create_download_session():
+    session = requests.Session()
+    session.headers.update({
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+    })
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=DOWNLOAD_MAX_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class PageDownloadError(Exception):
+    pass
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", 'jpeg'),
+    (b"\x89PNG\r\n\x1a\n", 'png'),
+    (b"GIF87a", 'gif'),
+    (b"GIF89a", 'gif'),
+    (b"BM", 'bmp'),
+)
+
+def sniff_image_type(head):
+    """Identify an image format from its first bytes, or None if it isn't one we can use"""
+    for signature, image_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return 'webp'
+    return None
+
+def download_image(session, img_url, dest_path):
+    """Stream one page to `dest_path`, honouring the per-host limits and retrying transient failures.
+
+    Retries back off exponentially; if a transfer breaks mid-body the next
+    attempt asks for the remainder with an HTTP Range request instead of
+    starting over.
+    """
+    semaphore, bucket = get_host_limiter(urlparse(img_url).netloc)
+    last_error = None
+
+    try:
+        with open(dest_path, 'w+b') as file:
+            for attempt in range(PAGE_MAX_RETRIES + 1):
+                if attempt:
+                    delay = PAGE_RETRY_BACKOFF * (2 ** (attempt - 1))
+                    time.sleep(delay + random.uniform(0, delay / 2))
+
+                size = file.tell()
+                headers = {"Range": f"bytes={size}-"} if size else {}
+                try:
+                    with semaphore:
+                        bucket.acquire()
+                        with session.get(img_url, headers=headers, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+                            content_range = response.headers.get('Content-Range', '')
+                            if response.status_code == 206 and content_range.startswith(f"bytes {size}-"):
+                                logger.debug(f"Resuming {img_url} at byte {size}")
+                            elif response.status_code == 200:
+                                # Fresh body (or the server ignored our Range header)
+                                file.seek(0)
+                                file.truncate()
+                                size = 0
+                            elif response.status_code == 416 and size:
+                                # The partial body no longer matches what the server has; start over
+                                file.seek(0)
+                                file.truncate()
+                                last_error = "HTTP 416 on resume"
+                                logger.warning(f"Attempt {attempt + 1} for {img_url} failed: {last_error}")
+                                continue
+                            elif response.status_code in RETRYABLE_STATUS_CODES or response.status_code == 206:
+                                last_error = f"HTTP {response.status_code}"
+                                logger.warning(f"Attempt {attempt + 1} for {img_url} failed: {last_error}")
+                                continue
+                            else:
+                                raise PageDownloadError(f"HTTP {response.status_code}")
+
+                            # Refuse oversized pages before reading any of the body
+                            content_length = response.headers.get('Content-Length')
+                            if content_length and content_length.isdigit():
+                                if size + int(content_length) > MAX_IMAGE_BYTES:
+                                    raise PageDownloadError(f"image is {size + int(content_length)} bytes, over the {MAX_IMAGE_BYTES} byte cap")
+
+                            sniffed = size >= 12
+                            for chunk in response.iter_content(chunk_size=16 * 1024):
+                                file.write(chunk)
+                                size += len(chunk)
+                                if size > MAX_IMAGE_BYTES:
+                                    raise PageDownloadError(f"image exceeded the {MAX_IMAGE_BYTES} byte cap")
+                                if not sniffed and size >= 12:
+                                    sniffed = True
+                                    if not sniff_image_type(read_file_head(file, 12)):
+                                        # HTML error pages, JSON, etc. - stop before transferring the rest
+                                        raise PageDownloadError(f"not an image (Content-Type {response.headers.get('Content-Type')})")
+                            if not sniffed and not sniff_image_type(read_file_head(file, 12)):
+                                raise PageDownloadError("response too short to be an image")
+                            return dest_path
+                except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema) as e:
+                    raise PageDownloadError(f"bad image URL: {e}")
+                except requests.RequestException as e:
+                    last_error = str(e)
+                    logger.warning(f"Attempt {attempt + 1} for {img_url} failed after {file.tell()} bytes: {last_error}")
+    except OSError as e:
+        # Disk errors while spooling (requests' own exceptions are OSErrors too)
+        raise PageDownloadError(str(e))
+
+    raise PageDownloadError(f"gave up after {PAGE_MAX_RETRIES + 1} attempts ({last_error})")
+
+def read_file_head(file, length):
+    """First bytes of a file being written, leaving the position at the end"""
+    file.seek(0)
+    head = file.read(length)
+    file.seek(0, os.SEEK_END)
+    return head
+
+def make_placeholder_page(page_number, reason):
+    """Blank JPEG page standing in for one that could not be downloaded"""
+    img = Image.new('RGB', (800, 1200), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.text((40, 560), f"Page {page_number} could not be downloaded", fill='black')
+    draw.text((40, 590), reason[:100], fill='gray')
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def download_images(session, image_urls, spool_dir, window=DOWNLOAD_WINDOW):
+    """Download pages concurrently into `spool_dir`, yielding their paths in page order.
+
+    Pages go straight to disk, and at most `window` pages are in flight or
+    waiting to be consumed, so memory stays flat no matter how long the
+    chapter is or how many chapters a worker runs at once.
+    """
+    def fetch(idx, img_url):
+        logger.debug(f"Downloading image {idx}: {img_url}")
+        page_path = os.path.join(spool_dir, f"page_{idx:04d}")
+        try:
+            if not img_url:
+                raise PageDownloadError("no usable image URL in its img tag")
+            return download_image(session, img_url, page_path)
+        except PageDownloadError as e:
+            if PAGE_FAILURE_POLICY == 'fail':
+                raise PageDownloadError(f"Page {idx} could not be downloaded: {e}")
+            logger.error(f"Page {idx} ({img_url}) failed, inserting placeholder: {e}")
+            with open(page_path, 'wb') as file:
+                file.write(make_placeholder_page(idx, str(e)))
+            return page_path
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_WORKERS) as executor:
+        pending = deque()
+        for idx, img_url in enumerate(image_urls, 1):
+            pending.append(executor.submit(fetch, idx, img_url))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def read_jpeg_info(data):
+    """Return (width, height, components) if `data` is a JPEG a PDF can embed verbatim.
+
+    Only 8-bit baseline/progressive Huffman JPEGs with 1 (gray) or 3 (YCbCr/RGB)
+    components qualify; anything else returns None and gets re-encoded.
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return None
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte before the real marker
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Standalone markers carry no length
+            pos += 2
+            continue
+
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        if marker in (0xC0, 0xC1, 0xC2):
+            if pos + 10 > len(data):
+                return None
+            precision = data[pos + 4]
+            height = int.from_bytes(data[pos + 5:pos + 7], "big")
+            width = int.from_bytes(data[pos + 7:pos + 9], "big")
+            components = data[pos + 9]
+            if precision != 8 or components not in (1, 3) or not width or not height:
+                return None
+            return width, height, components
+        if 0xC3 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # Lossless, hierarchical or arithmetic-coded frames
+            return None
+        if marker == 0xDA:
+            # Reached scan data without a frame header
+            return None
+        pos += 2 + length
+    return None
+
+def passthrough_page(image_data, max_bytes=None):
+    """Return the page as-is if it is a JPEG that already meets every limit, else None"""
+    jpeg_info = read_jpeg_info(image_data)
+    if not jpeg_info:
+        return None
+    width, height, components = jpeg_info
+    fits_width = not PAGE_MAX_WIDTH or width <= PAGE_MAX_WIDTH
+    fits_color = components == 1 or not PAGE_GRAYSCALE
+    fits_size = max_bytes is None or len(image_data) <= max_bytes
+    if fits_width and fits_color and fits_size:
+        color_space = "DeviceGray" if components == 1 else "DeviceRGB"
+        return image_data, width, height, color_space
+    return None
+
+def transcode_page(image, max_bytes=None):
+    """Decode and re-encode a page (raw bytes or a spooled file path); runs inside the transcode pool"""
+    source = io.BytesIO(image) if isinstance(image, bytes) else image
+    with Image.open(source) as img:
+        target_mode = 'L' if PAGE_GRAYSCALE or img.mode in ('L', '1') else 'RGB'
+        if PAGE_MAX_WIDTH and img.width > PAGE_MAX_WIDTH:
+            target_size = (PAGE_MAX_WIDTH, max(1, round(img.height * PAGE_MAX_WIDTH / img.width)))
+            # Let the JPEG decoder skip detail we are about to throw away
+            img.draft(target_mode, target_size)
+            img = img.convert(target_mode).resize(target_size, Image.LANCZOS)
+        elif img.mode != target_mode:
+            img = img.convert(target_mode)
+
+        quality = PAGE_JPEG_QUALITY
+        while True:
+            buffer = io.BytesIO()
+            img.save(buffer, "JPEG", quality=quality, optimize=True)
+            data = buffer.getvalue()
+            if max_bytes is None or len(data) <= max_bytes or quality <= PAGE_MIN_JPEG_QUALITY:
+                break
+            quality = max(quality - 10, PAGE_MIN_JPEG_QUALITY)
+
+        color_space = "DeviceGray" if target_mode == 'L' else "DeviceRGB"
+        return data, img.width, img.height, color_space
+
+_transcode_pool = None
+_transcode_pool_pid = None
+_transcode_pool_lock = threading.Lock()
+
+def get_transcode_pool():
+    """Process pool for page transcoding, created once per worker process.
+
+    Uses spawn so the children never inherit the download threads' locks.
+    """
+    global _transcode_pool, _transcode_pool_pid
+    with _transcode_pool_lock:
+        if _transcode_pool is None or _transcode_pool_pid != os.getpid():
+            _transcode_pool = ProcessPoolExecutor(
+                max_workers=TRANSCODE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _transcode_pool_pid = os.getpid()
+        return _transcode_pool
+
+def normalize_pages(page_paths, page_budget):
+    """Normalize spooled pages on the transcode pool, yielding results in page order.
+
+    JPEGs that can be passed through are resolved here without a round-trip
+    to the pool; other pages are handed over by path so their bytes are
+    never pickled. At most TRANSCODE_WINDOW pages are in flight at once, and
+    `page_budget()` is asked for each page's byte budget as it is submitted.
+    Each spooled file is deleted once its page has been produced.
+    """
+    pool = get_transcode_pool() if TRANSCODE_PROCESSES > 0 else None
+    pending = deque()
+
+    def finish(future, page_path):
+        result = future.result()
+        os.remove(page_path)
+        return result
+
+    try:
+        for page_path in page_paths:
+            max_bytes = page_budget()
+            with open(page_path, 'rb') as file:
+                result = passthrough_page(file.read(), max_bytes)
+            if result or not pool:
+                future = Future()
+                future.set_result(result or transcode_page(page_path, max_bytes))
+            else:
+                future = pool.submit(transcode_page, page_path, max_bytes)
+            pending.append((future, page_path))
+            if len(pending) >= TRANSCODE_WINDOW:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    except BrokenProcessPool:
+        # A crashed child (e.g. OOM on a huge page) poisons the pool; start fresh next time
+        reset_transcode_pool(pool)
+        raise
+    finally:
+        for future, _ in pending:
+            future.cancel()
+
+def reset_transcode_pool(broken_pool):
+    global _transcode_pool
+    with _transcode_pool_lock:
+        if _transcode_pool is broken_pool:
+            _transcode_pool = None
+    broken_pool.shutdown(wait=False)
+
+class StreamingPDFWriter:
+    """Minimal PDF writer that appends one image page at a time.
+
+    Each page is written to disk as soon as it is added; only object offsets
+    are kept in memory, so the whole chapter is never held at once.
+    """
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, path, expected_pages=None, size_budget=PDF_SIZE_BUDGET):
+        self.path = path
+        self.expected_pages = expected_pages
+        self.size_budget = size_budget
+        self.file = open(path, 'wb')
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self):
+        return len(self.page_ids)
+
+    @property
+    def size(self):
+        return self.file.tell()
+
+    def page_budget(self):
+        """Bytes the next page may use to keep the PDF within size_budget"""
+        if not self.expected_pages or not self.size_budget:
+            return None
+        pages_left = max(self.expected_pages - self.page_count, 1)
+        return max((self.size_budget - self.size) // pages_left, 0)
+
+    def _allocate_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id, body, stream=None):
+        self.offsets[obj_id] = self.file.tell()
+        self.file.write(f"{obj_id} 0 obj\n".encode())
+        self.file.write(body.encode())
+        if stream is not None:
+            self.file.write(b"\nstream\n")
+            self.file.write(stream)
+            self.file.write(b"\nendstream")
+        self.file.write(b"\nendobj\n")
+
+    def add_jpeg(self, data, width, height, color_space="DeviceRGB"):
+        """Append a page showing an already JPEG-encoded image at 72 dpi"""
+        image_id = self._allocate_id()
+        content_id = self._allocate_id()
+        page_id = self._allocate_id()
+
+        self._write_object(
+            image_id,
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace /{color_space} /BitsPerComponent 8 /Filter /DCTDecode "
+            f"/Length {len(data)} >>",
+            data
+        )
+        content = f"q {width} 0 0 {height} 0 0 cm /Im0 Do Q".encode()
+        self._write_object(content_id, f"<< /Length {len(content)} >>", content)
+        self._write_object(
+            page_id,
+            f"<< /Type /Page /Parent {self.PAGES_ID} 0 R /MediaBox [0 0 {width} {height}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        )
+        self.page_ids.append(page_id)
+
+    def close(self):
+        kids = " ".join(f"{page_id} 0 R" for page_id in self.page_ids)
+        self._write_object(self.PAGES_ID, f"<< /Type /Pages /Kids [{kids}] /Count {self.page_count} >>")
+        self._write_object(self.CATALOG_ID, f"<< /Type /Catalog /Pages {self.PAGES_ID} 0 R >>")
+
+        xref_offset = self.file.tell()
+        size = self.next_id
+        self.file.write(f"xref\n0 {size}\n0000000000 65535 f \n".encode())
+        for obj_id in range(1, size):
+            self.file.write(f"{self.offsets[obj_id]:010d} 00000 n \n".encode())
+        self.file.write(
+            f"trailer\n<< /Size {size} /Root {self.CATALOG_ID} 0 R >>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n".encode()
+        )
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Never leave a truncated PDF behind
+            self.abort()
+        return False
+
+class SplitPDFWriter:
+    """Streams pages into base.pdf, base_part2.pdf, ... rolling over at part_max_bytes.
+
+    `on_part_complete(path, part_number, is_last)` is called as soon as each
+    part is finished, so earlier parts can be delivered while later pages
+    are still downloading.
+    """
+    def __init__(self, base_path, expected_pages=None, part_max_bytes=PDF_PART_MAX_BYTES,
+                 on_part_complete=None):
+        self.base_path = base_path
+        self.expected_pages = expected_pages
+        self.part_max_bytes = part_max_bytes
+        self.on_part_complete = on_part_complete
+        self.parts = []
+        self.pages_in_finished_parts = 0
+        self.writer = self._start_part()
+
+    @property
+    def page_count(self):
+        return self.pages_in_finished_parts + self.writer.page_count
+
+    def page_budget(self):
+        if self.expected_pages:
+            self.writer.expected_pages = max(self.expected_pages - self.pages_in_finished_parts, 1)
+        return self.writer.page_budget()
+
+    def _part_path(self, part_number):
+        if part_number == 1:
+            return self.base_path
+        root, ext = os.path.splitext(self.base_path)
+        return f"{root}_part{part_number}{ext}"
+
+    def _start_part(self):
+        expected_pages = None
+        if self.expected_pages:
+            expected_pages = max(self.expected_pages - self.pages_in_finished_parts, 1)
+        return StreamingPDFWriter(
+            self._part_path(len(self.parts) + 1),
+            expected_pages=expected_pages,
+            size_budget=min(PDF_SIZE_BUDGET, self.part_max_bytes)
+        )
+
+    def _finish_part(self, is_last):
+        self.writer.close()
+        self.parts.append(self.writer.path)
+        self.pages_in_finished_parts += self.writer.page_count
+        logger.info(f"Finished PDF part {len(self.parts)}: {self.writer.path} ({self.writer.page_count} pages)")
+        if self.on_part_complete:
+            self.on_part_complete(self.writer.path, len(self.parts), is_last)
+
+    def add_page(self, data, width, height, color_space):
+        """Append an already normalized JPEG page, starting a new part if it would not fit"""
+        if self.writer.page_count and self.writer.size + len(data) > self.part_max_bytes:
+            self._finish_part(is_last=False)
+            self.writer = self._start_part()
+        self.writer.add_jpeg(data, width, height, color_space)
+
+    def close(self):
+        if self.writer.page_count:
+            self._finish_part(is_last=True)
+        else:
+            # Nothing was written since the last rollover (or at all)
+            self.writer.abort()
+
+    def abort(self):
+        self.writer.abort()
+        for path in self.parts:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+def enqueue_jobs(jobs):
+    """Push job dicts onto their sender's queue at their priority, in one round-trip"""
+    if not jobs:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for job in jobs:
+        enqueue_job_script(
+            keys=[
+                f"{JOB_QUEUE_KEY}:{job['priority']}:user:{job['sender']}",
+                f"{JOB_QUEUE_KEY}:{job['priority']}:ready",
+                JOB_DEPTH_KEY,
+                JOB_SIGNAL_KEY,
+                f"{JOB_QUEUE_KEY}:{job['priority']}:depth"
+            ],
+            args=[job['sender'], json.dumps(job)],
+            client=pipe
+        )
+    pipe.execute()
+    for job in jobs:
+        logger.info(f"Queued {job['type']} job for {job['sender']}: {job['url']}")
+
+def enqueue_chapter_jobs(requests_to_queue):
+    """Queue several (url, sender_number) chapter requests in one round-trip"""
+    jobs = []
+    for url, sender_number in requests_to_queue:
+        job_type = "batch" if is_batch_url(url) else "chapter"
+        jobs.append({
+            "type": job_type,
+            "priority": PRIORITY_BATCH if job_type == "batch" else PRIORITY_CHAPTER,
+            "url": url,
+            "sender": sender_number,
+            "enqueued_at": time.time()
+        })
+    enqueue_jobs(jobs)
+
+def enqueue_prefetch_jobs(chapter_urls):
+    """Queue cache pre-builds behind all user requests"""
+    enqueue_jobs([
+        {
+            "type": "prefetch",
+            "priority": PRIORITY_PREFETCH,
+            "url": chapter_url,
+            "sender": PREFETCH_SENDER,
+            "enqueued_at": time.time()
+        }
+        for chapter_url in chapter_urls
+    ])
+
+def worker_id_for(pid):
+    return f"{socket.gethostname()}:{pid}"
+
+def dequeue_job(worker_id):
+    """Return the next job payload the scheduler allows to run, or None"""
+    return dequeue_job_script(
+        keys=[JOB_DEPTH_KEY, JOB_SLOTS_KEY],
+        args=[JOB_QUEUE_KEY, USER_MAX_INFLIGHT, len(JOB_PRIORITIES), worker_id]
+    )
+
+def finish_job(worker_id):
+    """Free the in-flight slot this worker's job held (the sender is looked up in the slots hash)"""
+    finish_job_script(keys=[JOB_SIGNAL_KEY, JOB_SLOTS_KEY], args=[JOB_QUEUE_KEY, worker_id])
+
+def release_job_slots(worker_id=""):
+    """Reclaim in-flight slots from workers that died mid-job.
+
+    Covers every worker whose heartbeat is older than WORKER_HEARTBEAT_TTL,
+    plus `worker_id` straight away when the supervisor has seen it exit.
+    """
+    released = release_job_slots_script(
+        keys=[JOB_SLOTS_KEY, JOB_WORKERS_KEY, JOB_BUSY_KEY, JOB_SIGNAL_KEY],
+        args=[JOB_QUEUE_KEY, time.time() - WORKER_HEARTBEAT_TTL, worker_id]
+    )
+    if released:
+        logger.warning(f"Released {released} in-flight slot(s) held by dead workers")
+    return released
+
+def record_job_duration(job_type, seconds):
+    """Fold the run time of a job that actually built something into its type's average"""
+    try:
+        update_job_duration_script(keys=[f"{JOB_DURATION_KEY}:{job_type}"], args=[seconds, JOB_DURATION_ALPHA])
+    except redis.exceptions.ConnectionError as e:
+        logger.error(f"Could not record {job_type} job duration: {str(e)}")
+
+class WorkerHeartbeat:
+    """Advertise this worker process as live (and busy while it runs a job)"""
+    def __init__(self):
+        self.worker_id = worker_id_for(os.getpid())
+        self.busy = False
+        # Register before taking any job so the slot is never held by an unknown worker
+        self.set_busy(False)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def beat(self):
+        now = time.time()
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zadd(JOB_WORKERS_KEY, {self.worker_id: now})
+        if self.busy:
+            pipe.zadd(JOB_BUSY_KEY, {self.worker_id: now})
+        else:
+            pipe.zrem(JOB_BUSY_KEY, self.worker_id)
+        pipe.execute()
+
+    def set_busy(self, busy):
+        self.busy = busy
+        try:
+            self.beat()
+        except redis.exceptions.ConnectionError as e:
+            logger.error(f"Worker heartbeat failed: {str(e)}")
+
+    def _run(self):
+        while True:
+            try:
+                self.beat()
+            except redis.exceptions.ConnectionError as e:
+                logger.error(f"Worker heartbeat failed: {str(e)}")
+            time.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+def get_load_stats():
+    """Snapshot of queue depth per priority, live/busy workers and average build times"""
+    stale_before = time.time() - WORKER_HEARTBEAT_TTL
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zremrangebyscore(JOB_WORKERS_KEY, 0, stale_before)
+    pipe.zremrangebyscore(JOB_BUSY_KEY, 0, stale_before)
+    pipe.zcard(JOB_WORKERS_KEY)
+    pipe.zcard(JOB_BUSY_KEY)
+    for priority in JOB_PRIORITIES:
+        pipe.get(f"{JOB_QUEUE_KEY}:{priority}:depth")
+    for job_type in DEFAULT_JOB_SECONDS:
+        pipe.get(f"{JOB_DURATION_KEY}:{job_type}")
+    results = pipe.execute()
+    workers, busy = results[2:4]
+    depths = results[4:4 + len(JOB_PRIORITIES)]
+    durations = results[4 + len(JOB_PRIORITIES):]
+    return {
+        "depth": {priority: max(int(depth or 0), 0) for priority, depth in zip(JOB_PRIORITIES, depths)},
+        "workers": workers,
+        "busy": busy,
+        "utilization": busy / workers if workers else 1.0,
+        "avg_job_seconds": {
+            job_type: float(duration or default)
+            for (job_type, default), duration in zip(DEFAULT_JOB_SECONDS.items(), durations)
+        }
+    }
+
+def estimate_wait(stats, queued_ahead):
+    """Rough seconds until a new job starts behind `queued_ahead` ({job_type: count}).
+
+    The queued work is shared out across the live workers; when all of them
+    are busy, add roughly one chapter build for the jobs already running.
+    """
+    workers = max(stats['workers'], 1)
+    work = sum(count * stats['avg_job_seconds'][job_type] for job_type, count in queued_ahead.items())
+    if stats['busy'] >= workers:
+        work += workers * stats['avg_job_seconds']['chapter']
+    return work / workers
+
+def admit_job(stats, job_type, accepted):
+    """Return (accepted, estimated_wait) for a new `job_type` job.
+
+    Chapter jobs only wait behind queued chapters (batches run after them);
+    batch jobs wait behind both. `accepted` counts jobs of each type already
+    admitted from the same webhook batch.
+    """
+    queued_ahead = {"chapter": stats['depth'][PRIORITY_CHAPTER] + accepted.get("chapter", 0)}
+    if job_type == "batch":
+        queued_ahead["batch"] = stats['depth'][PRIORITY_BATCH] + accepted.get("batch", 0)
+    wait = estimate_wait(stats, queued_ahead)
+    if sum(queued_ahead.values()) >= ADMISSION_MAX_QUEUE_DEPTH:
+        return False, wait
+    if stats['utilization'] >= ADMISSION_MAX_UTILIZATION and wait > ADMISSION_MAX_WAIT:
+        return False, wait
+    return True, wait
+
+def run_job(job):
+    if job.get('type') == 'batch':
+        process_manga_batch(job['url'], job['sender'])
+    elif job.get('type') == 'prefetch':
+        prebuild_chapter(job['url'])
+    else:
+        process_manga_chapter(job['url'], job['sender'])
+
+def finish_job_until_released(worker_id, retry_delay):
+    """finish_job, retried through Redis outages so the sender is never left locked out"""
+    while True:
+        try:
+            finish_job(worker_id)
+            return
+        except redis.exceptions.ConnectionError as e:
+            logger.error(f"Could not release in-flight slot of {worker_id}, retrying: {str(e)}")
+            time.sleep(retry_delay)
+
+def worker_loop(poll_timeout=5):
+    """Drain the chapter job queue (one job at a time per process) until told to stop.
+
+    SIGTERM/SIGINT only stop the loop from taking new work: the job in hand
+    is finished and its slot released first, so a deploy never drops a
+    chapter the user was already told is being processed.
+    """
+    stop_requested = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info(f"Worker {os.getpid()} stopping after its current job")
+        stop_requested.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logger.info(f"Worker {os.getpid()} waiting for jobs on '{JOB_QUEUE_KEY}'")
+    heartbeat = WorkerHeartbeat()
+    while not stop_requested.is_set():
+        try:
+            payload = dequeue_job(heartbeat.worker_id)
+            if not payload:
+                # Sleep until something is queued or a sender frees a slot
+                redis_client.blpop(JOB_SIGNAL_KEY, timeout=poll_timeout)
+                continue
+        except redis.exceptions.ConnectionError as e:
+            logger.error(f"Redis unavailable, retrying: {str(e)}")
+            time.sleep(poll_timeout)
+            continue
+
+        try:
+            job = json.loads(payload)
+        except ValueError:
+            logger.error(f"Dropping malformed job: {payload}")
+            finish_job_until_released(heartbeat.worker_id, poll_timeout)
+            continue
+
+        wait_time = time.time() - job.get('enqueued_at', time.time())
+        logger.info(f"Worker {os.getpid()} picked up {job.get('url')} after {wait_time:.1f}s in queue")
+        heartbeat.set_busy(True)
+        try:
+            run_job(job)
+        except Exception as e:
+            # process_manga_chapter reports its own errors; never let one job kill the worker
+            logger.error(f"Unhandled error in job {job}: {str(e)}", exc_info=True)
+        finally:
+            heartbeat.set_busy(False)
+            finish_job_until_released(heartbeat.worker_id, poll_timeout)
+
+def normalize_chapter_url(url):
+    """Canonical form of a chapter URL so trivial variations share a cache entry"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    path = re.sub(r'/+', '/', parsed.path).rstrip('/')
+    return f"https://{host}{path}/"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_cached_chapter(url):
+    """Return the cached PDF part paths for a chapter URL, or None on a miss"""
+    chapter_key = normalize_chapter_url(url)
+    entry = redis_client.hgetall(f"chapter_cache:{chapter_key}")
+    if not entry:
+        return None
+    files = json.loads(entry['files'])
+    if not all(os.path.exists(path) for path in files):
+        logger.warning(f"Cached PDF for {chapter_key} is missing on disk, dropping entry")
+        remove_cached_chapter(chapter_key)
+        return None
+    redis_client.zadd("chapter_cache_lru", {chapter_key: time.time()})
+    return files
+
+def store_chapter_pdfs(url, pdf_paths):
+    """Move freshly built PDF parts into the cache and return their cached paths.
+
+    Files are named by content hash; a refcount per file lets two URLs that
+    produced identical PDFs share one copy on disk.
+    """
+    chapter_key = normalize_chapter_url(url)
+    os.makedirs(CHAPTER_CACHE_DIR, exist_ok=True)
+    cached_paths = []
+    digests = []
+    size = 0
+    for pdf_path in pdf_paths:
+        digest = file_sha256(pdf_path)
+        cached_path = os.path.join(CHAPTER_CACHE_DIR, f"{digest}.pdf")
+        size += os.path.getsize(pdf_path)
+        # Take our reference first so releasing an older entry (possibly this
+        # same URL with identical content) can never delete the shared file
+        redis_client.hincrby("chapter_cache_files", digest, 1)
+        if os.path.exists(cached_path):
+            os.remove(pdf_path)
+        else:
+            shutil.move(pdf_path, cached_path)
+        cached_paths.append(cached_path)
+        digests.append(digest)
+
+    # Replace any older entry for this URL before recording the new one
+    remove_cached_chapter(chapter_key)
+
+    pipe = redis_client.pipeline()
+    pipe.hset(f"chapter_cache:{chapter_key}", mapping={
+        "files": json.dumps(cached_paths),
+        "digests": json.dumps(digests),
+        "size": size,
+        "created_at": time.time()
+    })
+    pipe.incrby("chapter_cache_bytes", size)
+    pipe.zadd("chapter_cache_lru", {chapter_key: time.time()})
+    pipe.execute()
+
+    evict_chapter_cache()
+    return cached_paths
+
+def remove_cached_chapter(chapter_key):
+    size, *orphaned_files = remove_cached_chapter_script(
+        keys=[f"chapter_cache:{chapter_key}", "chapter_cache_lru", "chapter_cache_bytes", "chapter_cache_files"],
+        args=[chapter_key]
+    )
+    # Only files no other chapter URL points at any more
+    for path in orphaned_files:
+        if os.path.exists(path):
+            os.remove(path)
+    return int(size)
+
+def evict_chapter_cache(max_bytes=CHAPTER_CACHE_MAX_BYTES):
+    """Drop least recently used chapters until the cache fits in max_bytes"""
+    freed = 0
+    while int(redis_client.get("chapter_cache_bytes") or 0) > max_bytes:
+        oldest = redis_client.zrange("chapter_cache_lru", 0, 0)
+        if not oldest:
+            break
+        freed += remove_cached_chapter(oldest[0])
+        logger.info(f"Evicted {oldest[0]} from chapter cache")
+    return freed
+
+LAZY_SRC_ATTRIBUTES = ('data-src', 'data-lazy-src', 'data-original')
+SRCSET_ATTRIBUTES = ('data-srcset', 'data-lazy-srcset', 'srcset')
+# Known lazy-loading stand-in images, matched on the whole file name
+PLACEHOLDER_PATTERN = re.compile(r'^(placeholder|blank|loading|spacer|lazy)[-_.\w]*\.(gif|png|svg)$', re.IGNORECASE)
+
+def is_placeholder_url(url):
+    if not url or url.startswith('data:'):
+        return True
+    return bool(PLACEHOLDER_PATTERN.match(urlparse(url).path.rsplit('/', 1)[-1]))
+
+def pick_srcset_candidate(srcset, max_width=SRCSET_MAX_WIDTH):
+    """Largest width-described candidate no wider than max_width (or the narrowest if all are wider)"""
+    candidates = []
+    for candidate in srcset.split(','):
+        parts = candidate.split()
+        if len(parts) == 2 and parts[1].endswith('w') and parts[1][:-1].isdigit():
+            candidates.append((int(parts[1][:-1]), parts[0]))
+    if not candidates:
+        return None
+    candidates.sort()
+    fitting = [candidate for candidate in candidates if not max_width or candidate[0] <= max_width]
+    return (fitting[-1] if fitting else candidates[0])[1]
+
+def resolve_image_url(attrs):
+    """Real page URL of an <img>, looking past lazy-loading placeholders in `src`"""
+    for name in SRCSET_ATTRIBUTES:
+        if attrs.get(name):
+            url = pick_srcset_candidate(attrs[name])
+            if url and not is_placeholder_url(url):
+                return url
+    for name in LAZY_SRC_ATTRIBUTES:
+        url = (attrs.get(name) or '').strip()
+        if url and not is_placeholder_url(url):
+            return url
+    # Without lazy-loading attributes `src` is the page itself, whatever it is called
+    src = (attrs.get('src') or '').strip()
+    is_lazy = any(attrs.get(name) for name in LAZY_SRC_ATTRIBUTES + SRCSET_ATTRIBUTES)
+    if src and not src.startswith('data:') and not (is_lazy and is_placeholder_url(src)):
+        return src
+    return None
+
+class ChapterImageExtractor(HTMLParser):
+    """Incremental scanner for `img.wp-manga-chapter-img` sources.
+
+    Fed the chapter HTML chunk by chunk; it collects image URLs as soon as
+    their tags are seen and flags `done` once the `reading-content`
+    container closes, so the rest of the page never needs to be read.
+    """
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.seen = set()
+        self.found = []
+        self.container_depth = 0
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            # Rest of the chunk that contained the container's closing tag
+            return
+        if tag == 'div':
+            if self.container_depth:
+                self.container_depth += 1
+            elif 'reading-content' in (dict(attrs).get('class') or '').split():
+                self.container_depth = 1
+        elif tag == 'img':
+            attrs = dict(attrs)
+            if 'wp-manga-chapter-img' not in (attrs.get('class') or '').split():
+                return
+            image_url = resolve_image_url(attrs)
+            if not image_url:
+                # Keep the page's slot; download_images applies PAGE_FAILURE_POLICY to it
+                logger.warning(f"No usable image URL in chapter img tag: {attrs}")
+                self.found.append("")
+                return
+            image_url = urljoin(self.base_url, image_url)
+            # Lazy-loading themes sometimes repeat a page; fetch it only once
+            if image_url not in self.seen:
+                self.seen.add(image_url)
+                self.found.append(image_url)
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self.container_depth:
+            self.container_depth -= 1
+            if not self.container_depth:
+                self.done = True
+
+    def pop_found(self):
+        found, self.found = self.found, []
+        return found
+
+def fetch_chapter_image_urls(session, url):
+    """Yield the page image URLs of a chapter, using the Redis page-list cache.
+
+    A cached list younger than PAGE_LIST_FRESH_SECONDS is returned without
+    touching the site; an older one is revalidated with a conditional GET
+    and reused as-is on 304 Not Modified. Otherwise the HTML is streamed
+    through ChapterImageExtractor and URLs are yielded as they are parsed,
+    so downloads can start before the page has fully arrived.
+    """
+    cache_key = f"chapter_pages:{normalize_chapter_url(url)}"
+    cached = redis_client.get(cache_key)
+    cached = json.loads(cached) if cached else None
+    if cached and time.time() - cached['checked_at'] < PAGE_LIST_FRESH_SECONDS:
+        logger.debug(f"Using cached page list for {url}")
+        yield from cached['urls']
+        return
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    image_urls = []
+    with session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+        if response.status_code == 304 and cached:
+            logger.debug(f"Page list for {url} not modified")
+            cached['checked_at'] = time.time()
+            redis_client.setex(cache_key, PAGE_LIST_TTL, json.dumps(cached))
+            yield from cached['urls']
+            return
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch chapter page: HTTP {response.status_code}")
+
+        # requests assumes ISO-8859-1 for text/html without a charset; the site serves UTF-8
+        if 'charset' not in response.headers.get('Content-Type', ''):
+            response.encoding = 'utf-8'
+
+        extractor = ChapterImageExtractor(url)
+        for chunk in response.iter_content(chunk_size=16 * 1024, decode_unicode=True):
+            extractor.feed(chunk)
+            for image_url in extractor.pop_found():
+                image_urls.append(image_url)
+                yield image_url
+            if extractor.done:
+                break
+        else:
+            extractor.close()
+            for image_url in extractor.pop_found():
+                image_urls.append(image_url)
+                yield image_url
+
+        if image_urls:
+            redis_client.setex(cache_key, PAGE_LIST_TTL, json.dumps({
+                "urls": image_urls,
+                "etag": response.headers.get('ETag'),
+                "last_modified": response.headers.get('Last-Modified'),
+                "checked_at": time.time()
+            }))
+
+def build_chapter_pdfs(url, job_dir, pdf_basename, on_part_complete=None):
+    """Scrape a chapter and render it into one or more PDF parts inside `job_dir`"""
+    session = create_download_session()
+    image_urls = fetch_chapter_image_urls(session, url)
+    first_url = next(image_urls, None)
+    
+    if first_url is None:
+        raise Exception("No images found in this chapter.")
+    
+    # The URL list may still be streaming in; page budgets use what is known so far
+    seen_urls = [first_url]
+
+    def track_urls():
+        yield first_url
+        for image_url in image_urls:
+            seen_urls.append(image_url)
+            yield image_url
+        
+    # Download images and stream them straight into the PDF
+    base_path = os.path.join(job_dir, f"{pdf_basename}.pdf")
+
+    with SplitPDFWriter(base_path, on_part_complete=on_part_complete) as pdf:
+        def page_budget():
+            pdf.expected_pages = len(seen_urls)
+            return pdf.page_budget()
+
+        page_paths = download_images(session, track_urls(), job_dir)
+        for page in normalize_pages(page_paths, page_budget):
+            pdf.add_page(*page)
+
+    if not pdf.parts:
+        raise Exception("None of the chapter images could be downloaded")
+    return pdf.parts
+
+class ChapterBuildLock:
+    """Distributed single-flight lock on a chapter URL.
+
+    The holder's lease is renewed on a background thread, so a long build
+    keeps the lock while a crashed worker loses it after SINGLE_FLIGHT_LEASE
+    seconds. Requests that arrive meanwhile register in `waiters_key`.
+    """
+    def __init__(self, url):
+        chapter_key = normalize_chapter_url(url)
+        self.key = f"chapter_lock:{chapter_key}"
+        self.waiters_key = f"chapter_waiters:{chapter_key}"
+        self.token = uuid.uuid4().hex
+        self.held = False
+        self.stop_event = threading.Event()
+
+    def acquire(self):
+        if not redis_client.set(self.key, self.token, nx=True, ex=SINGLE_FLIGHT_LEASE):
+            return False
+        self.held = True
+        threading.Thread(target=self._keep_alive, name="chapter-lease", daemon=True).start()
+        return True
+
+    def _keep_alive(self):
+        while not self.stop_event.wait(SINGLE_FLIGHT_LEASE / 3):
+            if not extend_lock_script(keys=[self.key], args=[self.token, SINGLE_FLIGHT_LEASE]):
+                logger.warning(f"Lost lease on {self.key}")
+                return
+
+    def release(self):
+        self.stop_event.set()
+        release_lock_script(keys=[self.key], args=[self.token])
+        self.held = False
+
+    def add_waiter(self, sender_number):
+        """Ask the current builder to deliver to us; False if it finished before it could see us"""
+        pipe = redis_client.pipeline()
+        pipe.rpush(self.waiters_key, sender_number)
+        pipe.expire(self.waiters_key, CHAPTER_WAITERS_TTL)
+        pipe.execute()
+        if redis_client.exists(self.key):
+            return True
+        # The build ended in between; if our entry is still there, nobody will serve it
+        return redis_client.lrem(self.waiters_key, 1, sender_number) == 0
+
+    def pop_waiter(self):
+        return redis_client.lpop(self.waiters_key)
+
+class ChapterDelivery:
+    """Sends a chapter's PDF parts to one user and reports the outcome"""
+    def __init__(self, sender, sender_number, manga_title, chapter_num):
+        self.sender = sender
+        self.sender_number = sender_number
+        self.manga_title = manga_title
+        self.chapter_num = chapter_num
+        self.sent_parts = []
+        self.failure = None
+
+    def send_part(self, pdf_path, part_number, is_last):
+        if self.failure:
+            # Keep building for the cache, but stop spending the user's quota
+            return
+        caption = f"{self.manga_title} - Chapter {self.chapter_num}"
+        filename = f"{self.manga_title}_Chapter_{self.chapter_num}"
+        if not (part_number == 1 and is_last):
+            caption += f" (Part {part_number})"
+            if part_number > 1:
+                filename += f"_part{part_number}"
+        success, message = self.sender.send_document(
+            self.sender_number, pdf_path, caption, filename=f"{filename}.pdf"
+        )
+        if success:
+            self.sent_parts.append(pdf_path)
+        else:
+            self.failure = message
+
+    def send_all(self, pdf_parts):
+        for part_number, pdf_path in enumerate(pdf_parts, 1):
+            self.send_part(pdf_path, part_number, part_number == len(pdf_parts))
+
+    def report(self):
+        if self.failure:
+            self.sender.send_text(self.sender_number, f"Failed to send PDF file: {self.failure}")
+            return
+        sent_as = "as PDF file" if len(self.sent_parts) == 1 else f"as {len(self.sent_parts)} PDF files"
+        self.sender.send_text(
+            self.sender_number,
+            f"Successfully sent {self.manga_title} Chapter {self.chapter_num} {sent_as}.\n"
+            f"You have {self.sender.remaining_media(self.sender_number)} media messages remaining today."
+        )
+
+def serve_chapter_waiters(lock, url, manga_title, chapter_num, error=None):
+    """Deliver a finished build to everyone who asked for it while it was running"""
+    sender = WhatsAppFileSender()
+    pdf_parts = None if error else get_cached_chapter(url)
+    while True:
+        waiter = lock.pop_waiter()
+        if not waiter:
+            break
+        logger.info(f"Serving {manga_title} Chapter {chapter_num} to waiting user {waiter}")
+        if not pdf_parts:
+            sender.send_text(waiter, f"Error processing chapter: {error or 'the chapter could not be built'}")
+            continue
+        delivery = ChapterDelivery(sender, waiter, manga_title, chapter_num)
+        delivery.send_all(pdf_parts)
+        delivery.report()
+
+def parse_chapter_url(url):
+    """Extract the manga title and chapter number from a chapter URL"""
+    url_parts = url.strip().strip('/').split('/')
+    manga_title = url_parts[-2].replace('-', ' ').title()
+    chapter_num = url_parts[-1]
+    return manga_title, chapter_num
+
+def series_url_for(chapter_url):
+    """Series index page a chapter belongs to (the chapter URL minus its last segment)"""
+    return chapter_url.strip().rstrip('/').rsplit('/', 1)[0] + '/'
+
+def record_series_request(chapter_url):
+    """Remember that users are reading this series so the prefetcher watches it"""
+    redis_client.zadd("prefetch_series", {normalize_chapter_url(series_url_for(chapter_url)): time.time()})
+
+def fetch_series_chapter_urls(session, series_url):
+    """Chapter URLs listed on a series page, newest first as the site lists them.
+
+    Newer Madara themes load the list through an AJAX endpoint instead of
+    rendering it into the page, so that is tried when the page has none.
+    """
+    response = session.get(series_url, timeout=DOWNLOAD_TIMEOUT)
+    if response.status_code != 200:
+        raise Exception(f"Failed to fetch series page: HTTP {response.status_code}")
+    links = BeautifulSoup(response.text, 'html.parser').select("li.wp-manga-chapter a[href]")
+
+    if not links:
+        response = session.post(urljoin(series_url, "ajax/chapters/"), timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 200:
+            links = BeautifulSoup(response.text, 'html.parser').select("li.wp-manga-chapter a[href]")
+
+    chapter_urls = []
+    for link in links:
+        chapter_url = urljoin(series_url, link['href'].strip())
+        if chapter_url not in chapter_urls:
+            chapter_urls.append(chapter_url)
+    return chapter_urls
+
+def queue_is_idle():
+    return int(redis_client.get(JOB_DEPTH_KEY) or 0) <= 0
+
+def prebuild_chapter(url):
+    """Build a chapter into the cache with nobody to deliver it to (unless someone asks meanwhile)"""
+    if get_cached_chapter(url):
+        return True
+    lock = ChapterBuildLock(url)
+    if not lock.acquire():
+        return False
+    manga_title, chapter_num = parse_chapter_url(url)
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix="prefetch_", dir=TEMP_DIR)
+    error = None
+    try:
+        # Another builder may have stored it between our cache miss and taking the lock
+        if get_cached_chapter(url):
+            return True
+        logger.info(f"Prefetching {manga_title} Chapter {chapter_num}")
+        store_chapter_pdfs(url, build_chapter_pdfs(url, job_dir, f"{manga_title}_Chapter_{chapter_num}"))
+        return True
+    except Exception as e:
+        error = str(e)
+        logger.error(f"Prefetch of {url} failed: {error}")
+        return False
+    finally:
+        lock.release()
+        # Users who asked for it while we were building ride along
+        serve_chapter_waiters(lock, url, manga_title, chapter_num, error)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+def run_prefetch_pass():
+    """Check recently requested series for new chapters and queue pre-builds while idle.
+
+    The first time a series is seen its current chapters are only recorded;
+    after that, any chapter not seen before is queued as a lowest-priority
+    prefetch job, so the build runs on the worker pool rather than here. The
+    pass stops as soon as any jobs are waiting, including earlier prefetches.
+    """
+    redis_client.zremrangebyscore("prefetch_series", 0, time.time() - PREFETCH_SERIES_WINDOW)
+    session = create_download_session()
+    to_build = []
+
+    for series_url in redis_client.zrevrange("prefetch_series", 0, -1):
+        if not queue_is_idle():
+            break
+        try:
+            chapter_urls = fetch_series_chapter_urls(session, series_url)
+        except Exception as e:
+            logger.warning(f"Could not list chapters for {series_url}: {str(e)}")
+            continue
+
+        known_key = f"prefetch_known:{series_url}"
+        known = redis_client.smembers(known_key)
+        chapter_keys = [normalize_chapter_url(chapter_url) for chapter_url in chapter_urls]
+        if not known:
+            if chapter_keys:
+                redis_client.sadd(known_key, *chapter_keys)
+                redis_client.expire(known_key, PREFETCH_SERIES_WINDOW)
+            continue
+
+        new_chapters = [
+            (chapter_url, chapter_key)
+            for chapter_url, chapter_key in zip(chapter_urls, chapter_keys)
+            if chapter_key not in known
+        ]
+        for chapter_url, chapter_key in new_chapters[:PREFETCH_MAX_PER_SERIES]:
+            # Only mark a chapter known once it is cached, so a failed build is queued again next pass
+            if get_cached_chapter(chapter_url):
+                redis_client.sadd(known_key, chapter_key)
+            else:
+                to_build.append(chapter_url)
+        redis_client.expire(known_key, PREFETCH_SERIES_WINDOW)
+
+    enqueue_prefetch_jobs(to_build)
+    return len(to_build)
+
+def start_prefetcher(interval=PREFETCH_INTERVAL):
+    """Run prefetch passes every `interval` seconds on a daemon thread"""
+    def loop():
+        while True:
+            try:
+                queued = run_prefetch_pass()
+                if queued:
+                    logger.info(f"Prefetcher queued {queued} new chapters")
+            except Exception as e:
+                logger.error(f"Prefetch pass failed: {str(e)}", exc_info=True)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="prefetcher", daemon=True)
+    thread.start()
+    return thread
+
+CHAPTER_RANGE_PATTERN = re.compile(r'^chapter-(\d+)-to-(\d+)$')
+CHAPTER_NUMBER_PATTERN = re.compile(r'chapter-(\d+)(?:-(\d+))?')
+
+def parse_chapter_range(url):
+    """(first, last) for URLs ending in chapter-<first>-to-<last>, else None.
+
+    Madara writes chapter 10.5 as chapter-10-5, so a plain pair of numbers is
+    always a single chapter; ranges need the explicit "-to-".
+    """
+    match = CHAPTER_RANGE_PATTERN.match(url.strip().strip('/').split('/')[-1])
+    if not match:
+        return None
+    first, last = int(match.group(1)), int(match.group(2))
+    return (first, last) if last > first else None
+
+def is_series_url(url):
+    """True for a series index page (…/manga/<slug>/) rather than a chapter"""
+    path_parts = urlparse(url.strip()).path.strip('/').split('/')
+    return len(path_parts) == 2 and path_parts[0] == 'manga'
+
+def is_batch_url(url):
+    return bool(parse_chapter_range(url)) or is_series_url(url)
+
+def chapter_number(chapter_url):
+    match = CHAPTER_NUMBER_PATTERN.search(chapter_url.strip('/').split('/')[-1])
+    if not match:
+        return None
+    return float(f"{match.group(1)}.{match.group(2) or 0}")
+
+def chapter_label(chapter_url):
+    """Short chapter name for messages: 10, 10.5, or the raw slug if it has no number"""
+    number = chapter_number(chapter_url)
+    if number is None:
+        return parse_chapter_url(chapter_url)[1]
+    return f"{number:g}"
+
+def resolve_batch_chapters(session, url):
+    """Chapter URLs covered by a range or series request, in reading order"""
+    chapter_range = parse_chapter_range(url)
+    series_url = url.strip().rstrip('/') + '/' if is_series_url(url) else series_url_for(url)
+    try:
+        chapter_urls = list(reversed(fetch_series_chapter_urls(session, series_url)))
+    except Exception as e:
+        logger.warning(f"Could not list chapters for {series_url}: {str(e)}")
+        chapter_urls = []
+
+    if chapter_range:
+        first, last = chapter_range
+        listed = [
+            chapter_url for chapter_url in chapter_urls
+            if chapter_number(chapter_url) is not None and first <= chapter_number(chapter_url) <= last
+        ]
+        # Fall back to the site's usual slug pattern when the series list is unavailable
+        chapter_urls = listed or [f"{series_url}chapter-{number}/" for number in range(first, last + 1)]
+    return chapter_urls
+
+def download_chapter_pages(session, chapter_url, spool_dir):
+    """Spool every page of one chapter to disk, returning the page paths in order"""
+    os.makedirs(spool_dir, exist_ok=True)
+    return list(download_images(session, fetch_chapter_image_urls(session, chapter_url), spool_dir))
+
+def process_manga_batch(url, sender_number):
+    """Fetch a chapter range or a whole series and deliver it in as few PDFs as possible.
+
+    Up to BATCH_PARALLEL_CHAPTERS chapters download ahead of the writer
+    (sharing the per-host download limits), then are streamed in reading order into one
+    SplitPDFWriter, so the batch costs one media message per ~95MB rather
+    than one per chapter.
+    """
+    logger.info(f"Processing manga batch: {url} for {sender_number}")
     sender = WhatsAppFileSender()
     
     if not sender.can_send_media(sender_number):
         sender.send_text(
             sender_number, 
-            "You've reached your daily limit of 12 media messages. Please try again after 24 hours."
+            f"You've reached your daily limit of {MEDIA_DAILY_LIMIT} media messages. Please try again after 24 hours."
         )
         return
     
+    job_dir = None
+    started = time.time()
     try:
-        # Extract manga title and chapter number
-        url_parts = url.strip('/').split('/')
-        manga_title = url_parts[-2].replace('-', ' ').title()
-        chapter_num = url_parts[-1]
-        
-        logger.info(f"Starting download for {manga_title} Chapter {chapter_num}")
-        sender.send_text(sender_number, f"Starting to process {manga_title} Chapter {chapter_num}")
-        
-        # Create temp directory if it doesn't exist
-        os.makedirs("temp_manga", exist_ok=True)
-        
-        # Fetch and process images
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        images = soup.find_all("img", class_="wp-manga-chapter-img")
-        
-        if not images:
-            sender.send_text(sender_number, "No images found in this chapter.")
+        session = create_download_session()
+        chapter_urls = resolve_batch_chapters(session, url)
+        if not chapter_urls:
+            sender.send_text(sender_number, "No chapters found for this request.")
             return
-            
-        # Download images
-        session = requests.Session()
-        session.headers.update({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        })
-        
-        images_data = []
-        total_images = len(images)
-        
-        for idx, img in enumerate(images, 1):
-            img_url = img['src']
-            logger.debug(f"Downloading image {idx}/{total_images}: {img_url}")
-            
-            response = session.get(img_url)
-            if response.status_code == 200:
-                images_data.append((response.content, '.jpg'))
-            time.sleep(1)
-        
-        # Save as PDF instead of CBZ
-        pdf_filename = os.path.join("temp_manga", f"{manga_title}_Chapter_{chapter_num}.pdf")
-        
-        # Convert images to PDF
+        if len(chapter_urls) > BATCH_MAX_CHAPTERS:
+            sender.send_text(
+                sender_number,
+                f"Only the first {BATCH_MAX_CHAPTERS} of {len(chapter_urls)} chapters will be sent; "
+                f"send the next range afterwards for the rest."
+            )
+            chapter_urls = chapter_urls[:BATCH_MAX_CHAPTERS]
 
-        images_pil = []
-        first_image = None
-        
-        for idx, (image_data, _) in enumerate(images_data):
-            img = Image.open(io.BytesIO(image_data))
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')
-            if idx == 0:
-                first_image = img
-            else:
-                images_pil.append(img)
-        
-        if first_image:
-            first_image.save(pdf_filename, "PDF", save_all=True, append_images=images_pil)
-        
-        logger.info(f"Created PDF file: {pdf_filename}")
+        manga_title = parse_chapter_url(chapter_urls[0])[0]
+        first_chapter = chapter_label(chapter_urls[0])
+        last_chapter = chapter_label(chapter_urls[-1])
+        label = first_chapter if len(chapter_urls) == 1 else f"{first_chapter}-{last_chapter}"
+        sender.send_text(sender_number, f"Starting to process {manga_title} Chapters {label} ({len(chapter_urls)} chapters)")
+
+        os.makedirs(TEMP_DIR, exist_ok=True)
+        job_dir = tempfile.mkdtemp(prefix="batch_", dir=TEMP_DIR)
+        delivery = ChapterDelivery(sender, sender_number, manga_title, label)
+        skipped = []
+
+        executor = ThreadPoolExecutor(max_workers=BATCH_PARALLEL_CHAPTERS)
+        chapters = enumerate(chapter_urls, 1)
+        downloads = deque()
+
+        def fill_download_window():
+            # Only BATCH_PARALLEL_CHAPTERS chapters spool ahead of the one being written
+            for idx, chapter_url in islice(chapters, BATCH_PARALLEL_CHAPTERS - len(downloads)):
+                spool_dir = os.path.join(job_dir, f"chapter_{idx:04d}")
+                downloads.append((chapter_url, executor.submit(download_chapter_pages, session, chapter_url, spool_dir)))
+
+        def ordered_pages():
+            fill_download_window()
+            while downloads:
+                if delivery.failure:
+                    # Out of quota (or sending failed); nothing more can reach the user
+                    return
+                chapter_url, future = downloads.popleft()
+                fill_download_window()
+                try:
+                    page_paths = future.result()
+                except Exception as e:
+                    logger.error(f"Skipping {chapter_url} in batch: {str(e)}")
+                    skipped.append(chapter_label(chapter_url))
+                    continue
+                if not page_paths:
+                    skipped.append(chapter_label(chapter_url))
+                yield from page_paths
+
+        try:
+            base_path = os.path.join(job_dir, f"{manga_title}_Chapters_{label}.pdf")
+            with SplitPDFWriter(base_path, on_part_complete=delivery.send_part) as pdf:
+                for page in normalize_pages(ordered_pages(), pdf.page_budget):
+                    pdf.add_page(*page)
+                    if delivery.failure:
+                        break
+        finally:
+            # Don't wait on chapters nobody will read; only the ones already running
+            for _, future in downloads:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        if not pdf.parts:
+            raise Exception("None of the chapters could be downloaded")
+        if skipped:
+            sender.send_text(sender_number, f"These chapters could not be downloaded and were skipped: {', '.join(skipped)}")
+        delivery.report()
+        record_job_duration("batch", time.time() - started)
         
-        # Send PDF file
-        success, message = sender.send_document(
+    except Exception as e:
+        logger.error(f"Error in process_manga_batch: {str(e)}")
+        sender.send_text(sender_number, f"Error processing chapters: {str(e)}")
+    finally:
+        if job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+def process_manga_chapter(url, sender_number):
+    logger.info(f"Processing manga chapter: {url} for {sender_number}")
+    sender = WhatsAppFileSender()
+    
+    if not sender.can_send_media(sender_number):
+        sender.send_text(
             sender_number, 
-            pdf_filename,
-            f"{manga_title} - Chapter {chapter_num}"
+            f"You've reached your daily limit of {MEDIA_DAILY_LIMIT} media messages. Please try again after 24 hours."
         )
+        return
+    
+    job_dir = None
+    lock = None
+    build_error = None
+    try:
+        manga_title, chapter_num = parse_chapter_url(url)
+        record_series_request(url)
         
-        if success:
-            sender.send_text(
-                sender_number,
-                f"Successfully sent {manga_title} Chapter {chapter_num} as PDF file.\n"
-                f"You have {12 - sender.get_user_message_count(sender_number)} media messages remaining today."
-            )
-        else:
-            sender.send_text(sender_number, f"Failed to send PDF file: {message}")
+        delivery = ChapterDelivery(sender, sender_number, manga_title, chapter_num)
+        lock = ChapterBuildLock(url)
+        while True:
+            # Serve straight from the cache when someone already built this chapter
+            pdf_parts = get_cached_chapter(url)
+            if pdf_parts:
+                logger.info(f"Cache hit for {manga_title} Chapter {chapter_num}: {pdf_parts}")
+                delivery.send_all(pdf_parts)
+                break
+            
+            if lock.held:
+                build_started = time.time()
+                logger.info(f"Starting download for {manga_title} Chapter {chapter_num}")
+                sender.send_text(sender_number, f"Starting to process {manga_title} Chapter {chapter_num}")
+                # Parts are sent as each one completes, then kept for later requests
+                os.makedirs(TEMP_DIR, exist_ok=True)
+                job_dir = tempfile.mkdtemp(prefix="job_", dir=TEMP_DIR)
+                pdf_parts = build_chapter_pdfs(
+                    url, job_dir, f"{manga_title}_Chapter_{chapter_num}", on_part_complete=delivery.send_part
+                )
+                logger.info(f"Created PDF files: {pdf_parts}")
+                store_chapter_pdfs(url, pdf_parts)
+                # Cache hits and waiters return at once; only real builds feed the wait estimate
+                record_job_duration("chapter", time.time() - build_started)
+                break
+            
+            if lock.acquire():
+                # Check the cache again: the previous builder may have stored and released just after our miss
+                continue
+            
+            # Another worker is building this chapter right now; ride along on its result
+            if lock.add_waiter(sender_number):
+                logger.info(f"{manga_title} Chapter {chapter_num} already in progress, {sender_number} will be served by its builder")
+                sender.send_text(
+                    sender_number,
+                    f"{manga_title} Chapter {chapter_num} is already being prepared, it will be sent to you as soon as it is ready."
+                )
+                return
         
-        # Cleanup
-        if os.path.exists(pdf_filename):
-            os.remove(pdf_filename)
+        delivery.report()
         
     except Exception as e:
+        build_error = str(e)
         logger.error(f"Error in process_manga_chapter: {str(e)}")
         sender.send_text(sender_number, f"Error processing chapter: {str(e)}")
     finally:
-        # Clean up temp directory if empty
-        try:
-            os.rmdir("temp_manga")
-        except:
-            pass
+        if lock and lock.held:
+            lock.release()
+            try:
+                serve_chapter_waiters(lock, url, manga_title, chapter_num, build_error)
+            except Exception as e:
+                logger.error(f"Error serving waiting users for {url}: {str(e)}", exc_info=True)
+        # Only this job's spool; other jobs keep their own directories
+        if job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+def handle_statuses(statuses):
+    """Log delivery status updates Meta sends for our outgoing messages"""
+    for status in statuses:
+        message_id = status.get('id')
+        state = status.get('status')
+        recipient = status.get('recipient_id')
+        if state == 'failed':
+            errors = status.get('errors', [])
+            logger.error(f"Message {message_id} to {recipient} failed: {json.dumps(errors)}")
+        else:
+            logger.debug(f"Message {message_id} to {recipient} is {state}")
+
+_notice_pool = None
+_notice_pool_pid = None
+_notice_pool_lock = threading.Lock()
+
+def send_notices(notices):
+    """Send (recipient, text) replies on a background pool so the webhook returns at once.
+
+    Graph API timeouts and Retry-After waits then never hold up the HTTP
+    response, however many users have to be told.
+    """
+    global _notice_pool, _notice_pool_pid
+    if not notices:
+        return
+    with _notice_pool_lock:
+        if _notice_pool is None or _notice_pool_pid != os.getpid():
+            _notice_pool = ThreadPoolExecutor(max_workers=NOTICE_WORKERS, thread_name_prefix="notice")
+            _notice_pool_pid = os.getpid()
+        sender = WhatsAppFileSender()
+        for recipient, text in notices:
+            _notice_pool.submit(sender.send_text, recipient, text)
+
+def handle_messages(messages):
+    """Dedupe every message in a webhook batch and queue the chapter requests"""
+    message_ids = [message.get('id') for message in messages if message.get('id')]
+    claims = iter(claim_messages(message_ids) if message_ids else [])
+
+    chapter_requests = []
+    invalid_senders = []
+    for message in messages:
+        message_id = message.get('id')
+        # A duplicate delivery (even within this batch) loses the claim and is skipped
+        if message_id and not next(claims):
+            logger.info(f"Message {message_id} already processed, skipping")
+            continue
+
+        sender = message.get('from')
+        if message.get('type') != 'text':
+            continue
+
+        text = message['text']['body']
+        if 'lekmanga.net/manga/' in text:
+            chapter_requests.append((text, sender))
+        else:
+            invalid_senders.append(sender)
+
+    # Shed load when the workers are saturated instead of queueing unbounded work
+    accepted_requests = []
+    rejected = []
+    if chapter_requests:
+        stats = get_load_stats()
+        accepted = {}
+        for url, sender in chapter_requests:
+            job_type = "batch" if is_batch_url(url) else "chapter"
+            admitted, wait = admit_job(stats, job_type, accepted)
+            if admitted:
+                accepted[job_type] = accepted.get(job_type, 0) + 1
+                accepted_requests.append((url, sender))
+            else:
+                rejected.append((sender, wait))
+        if rejected:
+            logger.warning(
+                f"Overloaded (queued {stats['depth']}, {stats['busy']}/{stats['workers']} workers busy), "
+                f"turned away {len(rejected)} request(s)"
+            )
+
+    # Hand off to the worker pool so Meta gets its 200 right away
+    enqueue_chapter_jobs(accepted_requests)
+
+    notices = [
+        (recipient, "Please send a valid lekmanga.net manga chapter URL.")
+        for recipient in invalid_senders
+    ]
+    for recipient, wait in rejected:
+        minutes = max(1, round(wait / 60))
+        notices.append((
+            recipient,
+            f"The server is very busy right now (estimated wait about {minutes} minutes). "
+            "Please send your link again later."
+        ))
+    send_notices(notices)
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
@@ -268,45 +2314,21 @@ def webhook():
         data = request.get_json()
         logger.debug(f"Received webhook data: {json.dumps(data, indent=2)}")
         
-        # Check if this is a valid WhatsApp message webhook
-        if not data.get('entry', []):
-            logger.warning("No entry in webhook data")
-            return Response(status=200)
-            
-        entry = data['entry'][0]
-        if not entry.get('changes', []):
-            logger.warning("No changes in webhook entry")
-            return Response(status=200)
-            
-        change = entry['changes'][0]
-        value = change.get('value', {})
-        
-        if not value.get('messages', []):
-            logger.warning("No messages in webhook value")
-            return Response(status=200)
-            
-        message = value['messages'][0]
-        message_id = message.get('id')
+        # Meta may batch several entries, changes and messages into one POST
+        messages = []
+        statuses = []
+        for entry in data.get('entry', []):
+            for change in entry.get('changes', []):
+                value = change.get('value', {})
+                messages.extend(value.get('messages', []))
+                statuses.extend(value.get('statuses', []))
         
-        # Check if we've already processed this message
-        if message_id and is_processed_message(message_id):
-            logger.info(f"Message {message_id} already processed, skipping")
+        if not messages and not statuses:
+            logger.warning("No messages or statuses in webhook data")
             return Response(status=200)
         
-        sender = message.get('from')
-        if message.get('type') == 'text':
-            text = message['text']['body']
-            
-            if 'lekmanga.net/manga/' in text:
-                # Mark message as processed before starting
-                if message_id:
-                    mark_message_processed(message_id)
-                process_manga_chapter(text, sender)
-            else:
-                WhatsAppFileSender().send_text(
-                    sender,
-                    "Please send a valid lekmanga.net manga chapter URL."
-                )
+        handle_statuses(statuses)
+        handle_messages(messages)
         
         return Response(status=200)
         
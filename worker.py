@@ -0,0 +1,92 @@
+"""Chapter worker pool.
+
+Runs separately from the gunicorn web workers:
+
+    python worker.py
+
+Each process drains the Redis job queue filled by the webhook, so the number
+of chapter workers can be scaled independently of HTTP workers with the
+WORKER_PROCESSES environment variable. Each worker also gets
+TRANSCODE_PROCESSES page transcoding children, which by default split the
+cores between workers. The supervisor also runs the
+temp/cache janitor, and the chapter prefetcher when PREFETCH_ENABLED is set,
+on background threads; the prefetcher only lists series and queues the
+builds as lowest-priority jobs for the workers.
+"""
+import multiprocessing
+import signal
+import sys
+import time
+
+import redis
+
+from app import (
+    PREFETCH_ENABLED,
+    WORKER_PROCESSES,
+    WORKER_SHUTDOWN_TIMEOUT,
+    logger,
+    release_job_slots,
+    start_janitor,
+    start_prefetcher,
+    worker_id_for,
+    worker_loop,
+)
+
+
+def start_worker():
+    # Plain (non-daemon) processes so a job can still use its own pools. Spawned
+    # rather than forked: replacements start while the janitor and prefetcher
+    # threads may be holding logging, Redis or requests locks
+    process = multiprocessing.get_context('spawn').Process(target=worker_loop, name="manga-worker")
+    process.start()
+    return process
+
+
+def main():
+    logger.info(f"Starting {WORKER_PROCESSES} chapter worker processes")
+    workers = [start_worker() for _ in range(WORKER_PROCESSES)]
+    # One janitor per box keeps temp_manga and the chapter cache within the disk watermarks
+    start_janitor()
+    if PREFETCH_ENABLED:
+        start_prefetcher()
+
+    def shutdown(signum, frame):
+        # Workers treat SIGTERM as "finish the current job, then exit"
+        logger.info(f"Shutting down chapter workers (waiting up to {WORKER_SHUTDOWN_TIMEOUT}s for running jobs)")
+        for process in workers:
+            process.terminate()
+        deadline = time.time() + WORKER_SHUTDOWN_TIMEOUT
+        for process in workers:
+            process.join(timeout=max(deadline - time.time(), 0))
+        for process in workers:
+            if process.is_alive():
+                logger.warning(f"Worker {process.pid} still busy after {WORKER_SHUTDOWN_TIMEOUT}s, killing it")
+                process.kill()
+                process.join()
+                try:
+                    release_job_slots(worker_id_for(process.pid))
+                except redis.exceptions.ConnectionError as e:
+                    logger.error(f"Could not release the slot of worker {process.pid}: {str(e)}")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Replace any worker that crashed so the pool stays at full size, giving
+    # back the in-flight slot of whatever job it was running
+    while True:
+        try:
+            for idx, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.warning(f"Worker {process.pid} exited with {process.exitcode}, restarting")
+                    release_job_slots(worker_id_for(process.pid))
+                    workers[idx] = start_worker()
+            # Also covers workers on other boxes that died with their supervisor
+            release_job_slots()
+        except redis.exceptions.ConnectionError as e:
+            logger.error(f"Redis unavailable in supervisor: {str(e)}")
+        time.sleep(5)
+
+
+if __name__ == "__main__":
+    main()